@@ -1,10 +1,7 @@
 # %%
 import asyncio
-from collections import defaultdict
 from contextlib import asynccontextmanager
 import logging
-import os
-import threading
 from typing import Optional
 from openai import OpenAI, OpenAIError, AsyncOpenAI
 import openai
@@ -12,7 +9,7 @@ import json
 from tqdm import tqdm
 from memocache import Memoize
 from equivalent_model_wrapper import wrap_with_equivalent_models
-from parallel_processor import process_api_requests
+from parallel_processor import process_api_requests, rate_limit
 
 
 # %%
@@ -30,14 +27,32 @@ def is_rate_limit_exception(e):
 
 # %%
 
-# Equivalent model wrapper and memoization
+# Rate limiting, equivalent model wrapper, and memoization
+# The rate limit is innermost, so that cache hits don't use it up and each model tried counts against it
+
+max_requests_per_minute = 10000
+max_concurrent_requests = 64
 
 client.chat.completions.create = Memoize(
     wrap_with_equivalent_models(client.chat.completions.create),
     name="chat.completions.create",
 )
+# A parsed ChatCompletion doesn't carry the response headers, so rate-limit the raw endpoint, whose responses do,
+# and parse them afterwards
+rate_limited_raw_create = rate_limit(
+    aclient.chat.completions.with_raw_response.create,
+    requests_per_minute=max_requests_per_minute,
+    max_concurrent=max_concurrent_requests,
+)
+
+
+async def create_chat_completion(**kwargs):
+    response = await rate_limited_raw_create(**kwargs)
+    return response.parse()
+
+
 aclient.chat.completions.create = Memoize(
-    wrap_with_equivalent_models(aclient.chat.completions.create, force_async=True),
+    wrap_with_equivalent_models(create_chat_completion, force_async=True),
     name="chat.completions.create",
 )
 
@@ -76,55 +91,28 @@ temperatures = [0.1, 0.3, 0.5, 0.7, 0.9]
 output_file = "demo_outputs.jsonl"
 
 # %%
-file_path_cache = {}
-file_locks = defaultdict(lambda: threading.Lock())
-
-
-def append_jsonl(file_path, data: list):
-    with file_locks[file_path]:
-        if not os.path.exists(file_path):
-            with open(file_path, "w") as file:
-                pass
-    if file_path not in file_path_cache:
-        with file_locks[file_path]:
-            with open(file_path, "r") as file:
-                file_path_cache[file_path] = (set(file.readlines()), threading.Lock())
-    new_data = []
-    json_data = [json.dumps(record) + "\n" for record in data]
-    cache, lock = file_path_cache[file_path]
-    with lock:
-        for line in json_data:
-            if line not in cache and line not in new_data:
-                new_data.append(line)
-            else:
-                logging.warning(f"Ignoring duplicate: {line[:40]}...")
-        cache.update(new_data)
-    with file_locks[file_path]:
-        with open(file_path, "a") as file:
-            file.writelines(new_data)
-
 
-# %%
 
+def make_requests(occasion, temperature):
+    # built once here rather than on every attempt, since it never changes
+    request_arguments = dict(
+        model="gpt-3.5-turbo",
+        messages=[
+            {
+                "role": "system",
+                "content": "You are a greeting card text writer.",
+            },
+            {
+                "role": "user",
+                "content": "Please help me write a case for the following occasion: "
+                + occasion,
+            },
+        ],
+        temperature=temperature,
+    )
 
-def make_requests(occasion, temperature, output_file=output_file):
     async def requests():
         logging.debug(f"Starting request({occasion}, {temperature})")
-        request_arguments = dict(
-            model="gpt-3.5-turbo",
-            messages=[
-                {
-                    "role": "system",
-                    "content": "You are a greeting card text writer.",
-                },
-                {
-                    "role": "user",
-                    "content": "Please help me write a case for the following occasion: "
-                    + occasion,
-                },
-            ],
-            temperature=temperature,
-        )
         logging.debug(f"Calling chat.completions.create(**{request_arguments})")
         response = (
             (await aclient.chat.completions.create(**request_arguments))
@@ -140,9 +128,7 @@ def make_requests(occasion, temperature, output_file=output_file):
         logging.debug(
             f"Finished generating_requests({occasion}, {temperature}) -> {response}"
         )
-        await asyncio.to_thread(append_jsonl, output_file, [result])
-        logging.info(f"Wrote response to {occasion}, {temperature}) to disk!")
-        return result
+        return [result]
 
     requests.__str__ = (
         lambda: f"greeting card test for {occasion} with temperature {temperature}"
@@ -150,11 +136,78 @@ def make_requests(occasion, temperature, output_file=output_file):
     return requests
 
 
-list_of_requests = [
-    make_requests(occasion, temperature)
-    for occasion in occasions
-    for temperature in temperatures
-]
+def make_batched_requests(temperature, occasions=occasions):
+    """Like make_requests, but asks for the cards for all of the occasions in a single request, as a JSON object keyed by occasion."""
+
+    request_arguments = dict(
+        # JSON mode needs a model that supports response_format; this one isn't in an EQUIVALENT_MODELS group, so the
+        # equivalent model wrapper won't swap it for one that rejects it
+        model="gpt-3.5-turbo-1106",
+        messages=[
+            {
+                "role": "system",
+                "content": "You are a greeting card text writer.",
+            },
+            {
+                "role": "user",
+                "content": "Please help me write a card for each of the following occasions, "
+                "and respond with a JSON object mapping each occasion to its card text: "
+                + json.dumps(occasions),
+            },
+        ],
+        temperature=temperature,
+        response_format={"type": "json_object"},
+    )
+
+    async def requests():
+        logging.debug(f"Starting batched request({temperature})")
+        logging.debug(f"Calling chat.completions.create(**{request_arguments})")
+        response = (
+            (await aclient.chat.completions.create(**request_arguments))
+            .choices[0]
+            .message.content
+        )
+        try:
+            responses = json.loads(response)
+            if not isinstance(responses, dict):
+                raise ValueError(f"Expected a JSON object, got {response!r}")
+        except ValueError:  # including json.JSONDecodeError
+            # don't let the retry hit the same malformed response in the cache
+            aclient.chat.completions.create.uncache(**request_arguments)
+            raise
+
+        results = []
+        for occasion in occasions:
+            if occasion not in responses:
+                logging.warning(f"No response for {occasion}, {temperature}")
+                continue
+            result = dict(
+                occasion=occasion,
+                response=responses[occasion],
+                request_arguments=request_arguments,
+            )
+            results.append(result)
+        logging.debug(f"Finished batched request({temperature}) -> {responses}")
+        return results
+
+    requests.__str__ = (
+        lambda: f"greeting card test for {len(occasions)} occasions with temperature {temperature}"
+    )
+    return requests
+
+
+# Ask for all of the occasions at each temperature in one request, rather than making one request per (occasion, temperature)
+batch_occasions = True
+
+list_of_requests = (
+    [make_batched_requests(temperature) for temperature in temperatures]
+    if batch_occasions
+    else [
+        make_requests(occasion, temperature)
+        for occasion in occasions
+        for temperature in temperatures
+    ]
+)
 print(len(list_of_requests))
 
 list_of_requests = list_of_requests[:]
@@ -166,11 +219,12 @@ async def process_requests():
     with aclient.chat.completions.create.sync_cache(inplace=True):
         return await process_api_requests(
             requests=tqdm(list_of_requests, desc="Queuing", position=0).__iter__(),
-            max_requests_per_minute=10000,
+            max_requests_per_minute=max_requests_per_minute,
             max_attempts=10,
             is_rate_limit_exception=is_rate_limit_exception,
             is_api_exception=is_api_exception,
-            tqdm_requests=tqdm(list_of_requests, desc="Running", position=1).__iter__(),
+            tqdm_requests=tqdm(total=len(list_of_requests), desc="Running", position=1),
+            output_file=output_file,
         )
 
 
@@ -17,11 +17,24 @@ EQUIVALENT_MODELS = [
 ]
 
 
-def model_group_of_model(model, equivalent_models=EQUIVALENT_MODELS):
-    for groups in equivalent_models:
-        if model in groups:
-            return random.sample(groups, len(groups))
-    return [model]
+def group_of_model_map(equivalent_models=EQUIVALENT_MODELS):
+    return {model: tuple(group) for group in equivalent_models for model in group}
+
+
+_MODEL_TO_GROUP = group_of_model_map(EQUIVALENT_MODELS)
+
+
+def model_group_of_model(
+    model, equivalent_models=EQUIVALENT_MODELS, group_of_model=None
+):
+    if group_of_model is None:
+        group_of_model = (
+            _MODEL_TO_GROUP
+            if equivalent_models is EQUIVALENT_MODELS
+            else group_of_model_map(equivalent_models)
+        )
+    group = group_of_model.get(model)
+    return random.sample(group, len(group)) if group else [model]
 
 
 def wrap_with_equivalent_models(
@@ -29,9 +42,11 @@ def wrap_with_equivalent_models(
     equivalent_models=EQUIVALENT_MODELS,
     force_async: bool = False,
 ):
+    group_of_model = group_of_model_map(equivalent_models)
+
     def sync_wrapped_create_completion(*args, model, **kwargs):
         exception = None
-        for model in model_group_of_model(model, equivalent_models=equivalent_models):
+        for model in model_group_of_model(model, group_of_model=group_of_model):
             try:
                 return create_completion(*args, model=model, **kwargs)
             except Exception as e:
@@ -42,7 +57,7 @@ def wrap_with_equivalent_models(
 
     async def async_wrapped_create_completion(*args, model, **kwargs):
         exception = None
-        for model in model_group_of_model(model, equivalent_models=equivalent_models):
+        for model in model_group_of_model(model, group_of_model=group_of_model):
             try:
                 return await create_completion(*args, model=model, **kwargs)
             except Exception as e:
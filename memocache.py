@@ -1,10 +1,26 @@
+import hashlib
 import inspect
+import io
+import logging
 import pickle
-from typing import IO, Any, Callable, Optional, Tuple, TypeVar, Union
+import sqlite3
+import struct
+from typing import (
+    IO,
+    Any,
+    Callable,
+    Iterator,
+    MutableMapping,
+    Optional,
+    Tuple,
+    TypeVar,
+    Union,
+)
 from contextlib import (
     AbstractContextManager,
     contextmanager,
     asynccontextmanager,
+    nullcontext,
 )
 import concurrent.futures
 from frozendict import frozendict
@@ -12,6 +28,8 @@ import threading
 from filelock import FileLock
 from pathlib import Path
 import asyncio
+import atexit
+from collections import OrderedDict
 import tempfile, os
 
 pd = None
@@ -21,16 +39,71 @@ try:
 except ImportError:
     pass
 
-__all__ = ["Memoize", "USE_PANDAS"]
+zstd = None
+try:
+    import zstandard as zstd
+except ImportError:
+    pass
+
+orjson = None
+try:
+    import orjson
+except ImportError:
+    pass
+
+__all__ = ["Memoize", "SqliteCache", "USE_PANDAS"]
 
 USE_PANDAS = pd is not None
 
 T = TypeVar("T", bound=AbstractContextManager)
-KEY = Tuple[tuple, frozendict]
+_MISSING = object()
+
+# Pickled keys are compared byte-for-byte (as SQLite primary keys, and when digested), so their protocol is pinned;
+# values are only ever unpickled, so they use the fastest and most compact protocol available
+_KEY_PICKLE_PROTOCOL = 5
+_VALUE_PICKLE_PROTOCOL = pickle.HIGHEST_PROTOCOL
+KEY = Union[Tuple[tuple, frozendict], bytes]
+
+
+_SCALAR_TYPES = frozenset((str, int, float, bool, type(None), bytes))
+
+
+def _tuple_to_immutable(arg: tuple) -> tuple:
+    # a hashable tuple is already immutable all the way down, so it can be reused as is
+    try:
+        hash(arg)
+        return arg
+    except TypeError:
+        return tuple(to_immutable(e) for e in arg)
+
+
+def _list_to_immutable(arg: list) -> tuple:
+    if all(type(e) in _SCALAR_TYPES for e in arg):
+        return tuple(arg)
+    return tuple(to_immutable(e) for e in arg)
+
+
+def _dict_to_immutable(arg: dict) -> frozendict:
+    return frozendict({k: to_immutable(v) for k, v in arg.items()})
+
+
+# looked up by exact type, which is cheaper than a chain of isinstance checks
+_TO_IMMUTABLE_OF_TYPE = {
+    tuple: _tuple_to_immutable,
+    list: _list_to_immutable,
+    dict: _dict_to_immutable,
+}
 
 
 def to_immutable(arg: Any) -> Any:
     """Converts a list or dict to an immutable version of itself."""
+    arg_type = type(arg)
+    if arg_type in _SCALAR_TYPES:
+        return arg
+    convert = _TO_IMMUTABLE_OF_TYPE.get(arg_type)
+    if convert is not None:
+        return convert(arg)
+    # subclasses of list, tuple, and dict
     if isinstance(arg, list) or isinstance(arg, tuple):
         return tuple(to_immutable(e) for e in arg)
     elif isinstance(arg, dict):
@@ -39,17 +112,123 @@ def to_immutable(arg: Any) -> Any:
         return arg
 
 
-class DummyContextWrapper(AbstractContextManager):
-    def __enter__(self):
-        pass
+# use the compiled version of to_immutable if it has been built (cythonize -i _immutable.pyx)
+try:
+    from _immutable import to_immutable
+except ImportError:
+    pass
+
 
-    def __exit__(self, *args):
-        pass
+def _canonical(arg: Any) -> Any:
+    """Returns a frozen copy of arg whose dicts, at any depth, have their items in sorted order."""
+    arg_type = type(arg)
+    if arg_type in _SCALAR_TYPES:
+        return arg
+    if isinstance(arg, (list, tuple)):
+        return tuple(_canonical(e) for e in arg)
+    if isinstance(arg, dict):
+        items = [(_canonical(k), _canonical(v)) for k, v in arg.items()]
+        try:
+            items.sort(key=lambda item: item[0])
+        except TypeError:
+            # keys of mixed types, which don't compare with each other
+            items.sort(key=lambda item: canonical_dumps(item[0]))
+        return frozendict(items)
+    return arg
 
 
-def wrap_context(ctx: T, skip: bool = False) -> Union[T, DummyContextWrapper]:
+def canonical_dumps(arg: Any) -> bytes:
+    """Pickles arg so that equal arguments always give equal bytes.
+    Dicts are pickled with their items sorted, and nothing is memoized: pickle otherwise writes a repeated object as a
+    back-reference, so that f(a, a) and f(a, copy(a)) would pickle differently.
+    """
+    f = io.BytesIO()
+    pickler = pickle.Pickler(f, protocol=_KEY_PICKLE_PROTOCOL)
+    pickler.fast = True
+    pickler.dump(_canonical(arg))
+    return f.getvalue()
+
+
+def digest_of_args(args: tuple, kwargs: dict) -> bytes:
+    """Returns a 32-byte digest of the arguments, usable as a compact cache key.
+    Keyword arguments and dicts at any depth are sorted, so that the digest doesn't depend on the order they were built in.
+    """
+    return hashlib.blake2b(canonical_dumps((args, kwargs)), digest_size=32).digest()
+
+
+def wrap_context(ctx: T, skip: bool = False) -> Union[T, nullcontext]:
     """If skip is True, returns a dummy context manager that does nothing."""
-    return ctx if not skip else DummyContextWrapper()
+    return ctx if not skip else nullcontext()
+
+
+# Each record in the cache file is a 4-byte big-endian length followed by a pickled (key, value) pair
+_RECORD_HEADER = struct.Struct(">I")
+# Compressed record payloads are zstd frames, which start with this magic number
+_ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+# Cache files written with serializer="orjson" are lines of JSON objects
+_JSON_RECORD_PREFIX = b"{"
+# Cache files written before the log format are a single pickled dict, which starts with the PROTO opcode
+_LEGACY_PICKLE_PREFIX = b"\x80"
+
+
+def write_record(f: IO[bytes], key: Any, val: Any, compressor: Any = None):
+    """Writes a single (key, value) record to the cache log, compressing it with compressor (a zstandard.ZstdCompressor) if given."""
+    payload = pickle.dumps((key, val), protocol=_VALUE_PICKLE_PROTOCOL)
+    if compressor is not None:
+        payload = compressor.compress(payload)
+    f.write(_RECORD_HEADER.pack(len(payload)) + payload)
+
+
+def read_records(f: IO[bytes]) -> Iterator[Tuple[Any, Any]]:
+    """Reads (key, value) records from the cache log until EOF.
+    Raises EOFError after yielding the complete records if the file ends in a truncated record (e.g. from a crash mid-write).
+    """
+    while True:
+        header = f.read(_RECORD_HEADER.size)
+        if not header:
+            return
+        if len(header) < _RECORD_HEADER.size:
+            raise EOFError("truncated record header")
+        (length,) = _RECORD_HEADER.unpack(header)
+        payload = f.read(length)
+        if len(payload) < length:
+            raise EOFError("truncated record")
+        if payload[: len(_ZSTD_MAGIC)] == _ZSTD_MAGIC:
+            if zstd is None:
+                raise ImportError("zstandard is required to read compressed caches")
+            payload = zstd.ZstdDecompressor().decompress(payload)
+        yield pickle.loads(payload)
+
+
+def _orjson_default(obj: Any) -> Any:
+    if isinstance(obj, frozendict):
+        return dict(obj)
+    raise TypeError(f"Type is not JSON serializable: {type(obj).__name__}")
+
+
+def write_json_record(f: IO[bytes], key: KEY, val: Any):
+    """Writes a single (key, value) record to the cache log as a line of JSON, for serializer="orjson"."""
+    json_key = (
+        {"digest": key.hex()}
+        if isinstance(key, bytes)
+        else {"args": key[0], "kwargs": key[1]}
+    )
+    f.write(orjson.dumps({"k": json_key, "v": val}, default=_orjson_default) + b"\n")
+
+
+def read_json_records(f: IO[bytes]) -> Iterator[Tuple[KEY, Any]]:
+    """Reads records written by write_json_record until EOF, raising EOFError on a truncated final line."""
+    for line in f:
+        if not line.endswith(b"\n"):
+            raise EOFError("truncated record")
+        record = orjson.loads(line)
+        json_key = record["k"]
+        key = (
+            bytes.fromhex(json_key["digest"])
+            if "digest" in json_key
+            else (to_immutable(json_key["args"]), to_immutable(json_key["kwargs"]))
+        )
+        yield key, record["v"]
 
 
 def write_via_temp(file_path: Union[str, Path], do_write: Callable[[IO[bytes]], Any]):
@@ -67,21 +246,77 @@ def write_via_temp(file_path: Union[str, Path], do_write: Callable[[IO[bytes]],
             temp_file.close()
             os.remove(temp_file_path)
             raise
-    # Rename the existing cache file to a backup file
-    backup_file_path = f"{file_path}.bak"
-    try:
-        if os.path.exists(file_path):
-            os.rename(file_path, backup_file_path)
+    # Atomically replace the cache file, so that readers see either the old file or the new one, and never neither
+    os.replace(temp_file_path, file_path)
 
-        # Rename the temporary file to the cache file
-        os.rename(temp_file_path, file_path)
-    finally:
-        # Delete the backup file
-        if os.path.exists(backup_file_path):
-            if not os.path.exists(file_path):
-                os.rename(backup_file_path, file_path)
-            else:
-                os.remove(backup_file_path)
+
+class SqliteCache(MutableMapping):
+    """A dict-like cache backed by a SQLite table of pickled keys and values.
+    Reads are indexed lookups and writes are per-key upserts, so nothing ever (re)writes the whole cache.
+    """
+
+    def __init__(self, path: Union[str, Path]):
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS kv (key BLOB PRIMARY KEY, value BLOB)"
+        )
+        # the connection is shared among threads, so serialize access to it
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _dumps_key(key: Any) -> bytes:
+        # keys are looked up by their bytes, so equal keys must always pickle the same way
+        return canonical_dumps(key)
+
+    def __getitem__(self, key: Any) -> Any:
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT value FROM kv WHERE key=?", (self._dumps_key(key),)
+            ).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return pickle.loads(row[0])
+
+    def __setitem__(self, key: Any, val: Any):
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO kv (key, value) VALUES (?, ?)",
+                (
+                    self._dumps_key(key),
+                    pickle.dumps(val, protocol=_VALUE_PICKLE_PROTOCOL),
+                ),
+            )
+
+    def __delitem__(self, key: Any):
+        with self.lock:
+            cursor = self.conn.execute(
+                "DELETE FROM kv WHERE key=?", (self._dumps_key(key),)
+            )
+        if cursor.rowcount == 0:
+            raise KeyError(key)
+
+    def __contains__(self, key: Any) -> bool:
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT 1 FROM kv WHERE key=?", (self._dumps_key(key),)
+            ).fetchone()
+        return row is not None
+
+    def __iter__(self) -> Iterator[Any]:
+        with self.lock:
+            rows = self.conn.execute("SELECT key FROM kv").fetchall()
+        return (pickle.loads(row[0]) for row in rows)
+
+    def __len__(self) -> int:
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM kv").fetchone()[0]
+
+    def checkpoint(self):
+        """Folds the write-ahead log back into the main database file."""
+        with self.lock:
+            self.conn.execute("PRAGMA wal_checkpoint")
 
 
 # https://stackoverflow.com/a/63425191/377022
@@ -98,9 +333,22 @@ async def async_lock(lock):
         lock.release()
 
 
+class CacheFileState:
+    """What a Memoize knows about its cache file, shared by all of the instances that read and write the same file."""
+
+    def __init__(self):
+        self.num_records: int = 0
+        self.needs_compaction: bool = False
+        # (inode, size, mtime) of the cache file as of our last read or write of it
+        self.stat: Optional[Tuple[int, int, int]] = None
+        # how far into the cache file we have read, and whether it holds JSON records
+        self.offset: int = 0
+        self.is_json: bool = False
+
+
 class Memoize:
     """A memoization decorator that caches the results of a function call.
-    The cache is stored in a file, so it persists between runs.
+    The cache is stored in an append-only log file, so it persists between runs and each new result only writes its own record.
     The cache is also thread-safe, so it can be used in a multithreaded environment.
     The cache is also exception-safe, so it won't be corrupted if there's an error.
     """
@@ -109,6 +357,9 @@ class Memoize:
 
     cache_base_dir = "cache"
 
+    # cache directories that this process has already made sure exist
+    _dirs_created: set = set()
+
     def __init__(
         self,
         func: Callable,
@@ -118,20 +369,55 @@ class Memoize:
         use_pandas: Optional[bool] = None,
         force_async: bool = False,
         process_half_async: bool = True,
+        backend: str = "pickle",
+        hash_keys: bool = False,
+        flush_interval: Optional[float] = None,
+        flush_threshold: Optional[int] = None,
+        hot_cache_size: int = 1024,
+        compress: bool = False,
+        serializer: str = "pickle",
+        value_adapter: Callable[[Any], Any] = (lambda val: val),
+        value_loader: Callable[[Any], Any] = (lambda val: val),
     ):
         """Initializes the memoization decorator.
 
         process_half_async: if a synchronous function returns a tuple or list of coroutines, then, when this is true, we jump through some extra hoops to ensure that the coroutines are awaited before the result is cached.
+        backend: "pickle" stores the cache in memory, backed by an append-only log file; "sqlite" stores it in a SQLite database (WAL mode), looking up and upserting one key at a time.
+        hash_keys: if true, cache entries are keyed by a digest of the pickled arguments rather than by a frozen copy of them.  This is cheaper to build and store for large arguments, but the arguments can no longer be recovered from the key, and caches built with and without it are not interchangeable.
+        flush_interval: if not None, new results are only stored in memory on the hot path, and a background thread appends them to the cache file every flush_interval seconds (and at exit).  Results computed since the last flush are lost if the process crashes.
+        flush_threshold: if not None, new results are buffered in memory as with flush_interval, and the background thread flushes them as soon as flush_threshold of them are pending (in addition to every flush_interval seconds, if that is also given).
+        hot_cache_size: the number of most recently used results to keep in an in-memory LRU that is checked before anything else, without taking any locks or looking at the disk.
+        compress: if true, records in the cache file are compressed with zstandard, which typically shrinks LLM responses several-fold.  Compressed and uncompressed records can be mixed in the same file.
+        serializer: "pickle" or "orjson".  With "orjson", the cache file is written as lines of JSON, which is faster to encode and decode than pickle and portable across Python versions, but requires JSON-compatible arguments (with string dict keys) and values.  value_adapter converts results to something JSON-serializable before they are written (e.g. lambda r: r.model_dump() for OpenAI responses), and value_loader converts them back when they are read.
         """
         if use_pandas is None:
             use_pandas = USE_PANDAS
         if isinstance(func, Memoize):
             self.func = func.func
             self.name: str = name or func.name
-            self.cache_file = Path(cache_file or func.cache_file).absolute()
-            self.cache: dict = func.cache
+            self.cache_file = (
+                Path(cache_file).absolute()
+                if cache_file is not None
+                else func.cache_file
+            )
+            self.backend: str = func.backend
+            self.hash_keys: bool = func.hash_keys
+            self.thread_lock: threading.RLock = func.thread_lock
+            self.flush_interval: Optional[float] = func.flush_interval
+            self.flush_threshold: Optional[int] = func.flush_threshold
+            self._flush_requested: threading.Event = func._flush_requested
+            self._dirty: dict = func._dirty
+            self._flush_lock: threading.Lock = func._flush_lock
+            self._hot: OrderedDict = func._hot
+            self.hot_cache_size: int = func.hot_cache_size
+            self._inflight: dict = func._inflight
+            self.compress: bool = func.compress
+            self.serializer: str = func.serializer
+            self.value_adapter: Callable[[Any], Any] = func.value_adapter
+            self.value_loader: Callable[[Any], Any] = func.value_loader
+            self.cache: MutableMapping = func.cache
             self.df_cache: set = func.df_cache
-            self.df = func.df
+            self._df_rows: Optional[list] = func._df_rows
             self.df_thread_lock: threading.Lock = func.df_thread_lock
             self.file_lock = func.file_lock
             self.force_async = func.force_async
@@ -139,100 +425,439 @@ class Memoize:
             if name is not None:
                 Memoize.instances[name] = self
         else:
+            if backend not in ("pickle", "sqlite"):
+                raise ValueError(f"Unknown backend {backend!r}")
+            if compress and zstd is None:
+                raise ImportError("compress=True requires zstandard")
+            if serializer not in ("pickle", "orjson"):
+                raise ValueError(f"Unknown serializer {serializer!r}")
+            if serializer == "orjson":
+                if orjson is None:
+                    raise ImportError('serializer="orjson" requires orjson')
+                if backend != "pickle" or compress:
+                    raise ValueError(
+                        'serializer="orjson" is only supported by the log backend, without compression'
+                    )
             self.func = func
             self.name = name or func.__name__
+            self.backend = backend
+            self.hash_keys = hash_keys
+            suffix = "sqlite" if backend == "sqlite" else "pkl"
             self.cache_file = Path(
-                cache_file or (Path(Memoize.cache_base_dir) / f"{self.name}_cache.pkl")
+                cache_file
+                or (Path(Memoize.cache_base_dir) / f"{self.name}_cache.{suffix}")
             ).absolute()
-            self.cache: dict = {}
             self.df_cache: set = set()
-            self.df = (
-                pd.DataFrame(columns=["input", "output"])
-                if use_pandas and pd is not None
-                else None
-            )
+            # rows are only turned into a DataFrame when self.df is accessed
+            self._df_rows = [] if use_pandas and pd is not None else None
             self.df_thread_lock: threading.Lock = threading.Lock()
             self.file_lock: FileLock = FileLock(f"{self.cache_file}.lock")
             self.force_async = force_async
             self.process_half_async = process_half_async
+            self.thread_lock = threading.RLock()
+            self.flush_interval = flush_interval
+            self.flush_threshold = flush_threshold
+            # set to wake the background thread up for an early flush
+            self._flush_requested = threading.Event()
+            # results that have been cached in memory but not yet appended to the cache file
+            self._dirty = {}
+            # held from taking results out of _dirty until they are on disk, so that a flush waits for one in progress
+            self._flush_lock = threading.Lock()
+            self._hot = OrderedDict()
+            self.hot_cache_size = hot_cache_size
+            # futures for the results of async calls that are currently running
+            self._inflight = {}
+            self.compress = compress
+            self.serializer = serializer
+            self.value_adapter = value_adapter
+            self.value_loader = value_loader
             Memoize.instances[self.name] = self
-            self.cache_file.parent.mkdir(parents=True, exist_ok=True)
+            if self.cache_file.parent not in Memoize._dirs_created:
+                self.cache_file.parent.mkdir(parents=True, exist_ok=True)
+                Memoize._dirs_created.add(self.cache_file.parent)
+            self.cache: MutableMapping = (
+                SqliteCache(self.cache_file) if backend == "sqlite" else {}
+            )
+        self._df_materialized = None
+        self._df_num_materialized: int = 0
+        # instances sharing a cache file must agree on what is in it, or one could append after a record the others can't read
+        self._disk: CacheFileState = (
+            func._disk
+            if isinstance(func, Memoize) and self.cache_file == func.cache_file
+            else CacheFileState()
+        )
+        self._reload_task: Optional[asyncio.Future] = None
+        if not isinstance(func, Memoize):
             self._load_cache_from_disk()
+            if self._buffers_writes:
+                threading.Thread(target=self._flush_periodically, daemon=True).start()
+        # decided once here, since inspect is slow enough to matter on every call
+        self._is_async: bool = (
+            inspect.iscoroutinefunction(self.func) or self.force_async
+        )
         self.disk_write_only: int = disk_write_only
         self.disk_write_only_lock: threading.Lock = threading.Lock()
         for attr in ("__doc__", "__name__", "__module__"):
             if hasattr(func, attr):
                 setattr(self, attr, getattr(func, attr))
 
-    def _load_cache_from_disk(self, use_lock: bool = True):
-        """Loads the cache from disk.  If use_lock is True, then the cache is locked while it's being loaded."""
-        with wrap_context(self.file_lock, skip=not use_lock):
-            try:
+    @staticmethod
+    def _stat_signature(st: os.stat_result) -> Tuple[int, int, int]:
+        return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+    def _maybe_reload_cache(self):
+        """Reloads the cache from disk only if the cache file has changed since we last read or wrote it."""
+        if self.backend == "sqlite":
+            return
+        try:
+            disk_stat = self._stat_signature(os.stat(self.cache_file))
+        except FileNotFoundError:
+            return
+        if disk_stat != self._disk.stat:
+            self._load_cache_from_disk()
+
+    async def _async_maybe_reload_cache(self):
+        """Runs _maybe_reload_cache in a worker thread, sharing a single run among all the calls that want one at the same time."""
+        task = self._reload_task
+        if (
+            task is None
+            or task.done()
+            or task.get_loop() is not asyncio.get_running_loop()
+        ):
+            task = self._reload_task = asyncio.ensure_future(
+                asyncio.to_thread(self._maybe_reload_cache)
+            )
+        await asyncio.shield(task)
+
+    def _load_cache_from_disk(self, use_lock: bool = False):
+        """Loads the cache from disk.  If use_lock is True, then the cache is locked while it's being loaded.
+
+        Writers only ever append whole records to the cache file or atomically replace it, so reading doesn't need the lock,
+        except to tell a record that is still being appended apart from one torn by a crash; for that, we reread with the lock.
+        """
+        if self.backend == "sqlite":
+            # the database is the cache, so there is nothing to load
+            return
+        try:
+            with wrap_context(self.file_lock, skip=not use_lock):
                 with open(self.cache_file, "rb") as f:
-                    disk_cache = pickle.load(f)
-            except FileNotFoundError:
-                return
-        self.cache.update(disk_cache)
+                    disk_stat = self._stat_signature(os.fstat(f.fileno()))
+                    disk_cache = self._read_appended_records(
+                        f, disk_stat, locked=use_lock
+                    )
+                    if disk_cache is None:
+                        f.seek(0)
+                        disk_cache = self._read_all_records(f, locked=use_lock)
+        except FileNotFoundError:
+            return
+        except EOFError:
+            if use_lock:
+                # nobody can be appending while we hold the lock, so the file is truncated in a way we can't recover from
+                raise
+            return self._load_cache_from_disk(use_lock=True)
+        with self.thread_lock:
+            self.cache.update(disk_cache)
+            # results that haven't been flushed yet are newer than anything on disk
+            self.cache.update(self._dirty)
+        self._disk.stat = disk_stat
+
+    def _read_appended_records(
+        self, f: IO[bytes], disk_stat: Tuple[int, int, int], locked: bool = True
+    ) -> Optional[dict]:
+        """If the cache file is the one we last read and has only been appended to since, reads just the new records.
+        Returns None if the whole file needs to be read instead.  If not locked, raises EOFError on a truncated record.
+        """
+        if (
+            self._disk.stat is None
+            or self._disk.offset == 0
+            or disk_stat[0] != self._disk.stat[0]
+            or disk_stat[1] < self._disk.offset
+        ):
+            return None
+        f.seek(self._disk.offset)
+        try:
+            disk_cache, num_records, offset = self._read_records_from(
+                f, self._disk.is_json
+            )
+        except EOFError:
+            if not locked:
+                # most likely a record that is still being appended, which rereading the whole file wouldn't get past either
+                raise
+            # a torn write, or the inode was reused for a different file; the full read sorts out which
+            return None
+        except Exception:
+            # the inode was reused for a different file
+            return None
+        self._disk.num_records += num_records
+        self._disk.offset = offset
+        return disk_cache
 
-    def _write_cache_to_disk(self, skip_load: bool = False, use_lock: bool = True):
-        """Writes the cache to disk.  The cache is locked while it's being written."""
+    def _read_all_records(self, f: IO[bytes], locked: bool = True) -> dict:
+        """Reads the whole cache file.  If not locked, raises EOFError on a truncated record rather than treating it as torn."""
+        prefix = f.peek(1)[:1]
+        if prefix == _LEGACY_PICKLE_PREFIX:
+            disk_cache = pickle.load(f)
+            self._disk.num_records = len(disk_cache)
+            self._disk.offset = 0
+            # convert to the log format on the next write
+            self._disk.needs_compaction = True
+            return disk_cache
+        is_json = prefix == _JSON_RECORD_PREFIX
+        if prefix and is_json != (self.serializer == "orjson"):
+            # convert to our serializer on the next write, so that we don't append mixed records
+            self._disk.needs_compaction = True
+        try:
+            disk_cache, num_records, offset = self._read_records_from(f, is_json)
+        except EOFError as e:
+            if not locked:
+                raise
+            disk_cache, num_records, offset = e.args[1:]
+            logging.warning(f"Ignoring {e.args[0]} at the end of {self.cache_file}")
+            # appending after a torn record would hide the new records, so rewrite the file instead
+            self._disk.needs_compaction = True
+        self._disk.num_records = num_records
+        self._disk.offset = offset
+        self._disk.is_json = is_json
+        return disk_cache
+
+    def _read_records_from(self, f: IO[bytes], is_json: bool) -> Tuple[dict, int, int]:
+        """Reads records from the current position of f to EOF.
+        Returns them along with how many there were and the offset just past the last one.
+        On a truncated record, raises EOFError(message, records, num_records, offset) for the complete records before it.
+        """
+        if is_json and orjson is None:
+            raise ImportError(f"orjson is required to read {self.cache_file}")
+        disk_cache = {}
+        num_records = 0
+        offset = f.tell()
+        try:
+            for key, val in read_json_records(f) if is_json else read_records(f):
+                disk_cache[key] = self.value_loader(val) if is_json else val
+                num_records += 1
+                offset = f.tell()
+        except EOFError as e:
+            raise EOFError(str(e), disk_cache, num_records, offset) from e
+        return disk_cache, num_records, offset
+
+    def _write_cache_to_disk(
+        self,
+        skip_load: bool = False,
+        use_lock: bool = True,
+        pending: Optional[dict] = None,
+    ):
+        """Rewrites the whole cache to disk as a compacted log.  The cache is locked while it's being written.
+        Unless skip_load is True, first merges in anything other processes have written.  pending holds results that are cached
+        in memory but not on disk yet, which take precedence over what's on disk."""
+        if self.backend == "sqlite":
+            self.cache.checkpoint()
+            return
         with wrap_context(self.file_lock, skip=not use_lock):
             if not skip_load:
-                self._load_cache_from_disk(use_lock=False)
+                # there is nothing to merge if nobody has written since we last read or wrote the file
+                self._maybe_reload_cache()
+            if pending:
+                self.cache.update(pending)
+            items = list(self.cache.items())
+
+            def do_write(f):
+                write = self._record_writer()
+                for key, val in items:
+                    write(f, key, val)
+
             # use a tempfile so that we don't corrupt the cache if there's an error
-            write_via_temp(self.cache_file, (lambda f: pickle.dump(self.cache, f)))
+            write_via_temp(self.cache_file, do_write)
+            self._disk.num_records = len(items)
+            self._disk.needs_compaction = False
+            self._disk.stat = self._stat_signature(os.stat(self.cache_file))
+            self._disk.offset = self._disk.stat[1]
+            self._disk.is_json = self.serializer == "orjson"
+
+    def _should_compact(self) -> bool:
+        """Whether the cache file has accumulated enough stale or unreadable records that it should be rewritten."""
+        # a cache file with no records needs no rewriting, and one that doesn't exist shouldn't be created
+        return self._disk.needs_compaction or (
+            self._disk.num_records > 0 and self._disk.num_records >= 2 * len(self.cache)
+        )
+
+    def compact(self):
+        """Rewrites the cache file with exactly one record per cached entry."""
+        self._flush()
+        self._write_cache_to_disk()
+
+    def _record_writer(self) -> Callable[[IO[bytes], KEY, Any], None]:
+        """Returns a function that writes a record to the cache file in our format."""
+        if self.serializer == "orjson":
+            return lambda f, key, val: write_json_record(
+                f, key, self.value_adapter(val)
+            )
+        # compressors are not thread-safe, so make a fresh one for each write
+        compressor = zstd.ZstdCompressor(level=3) if self.compress else None
+        return lambda f, key, val: write_record(f, key, val, compressor)
+
+    def _append_entry(self, key: KEY, val: Any):
+        """Appends a single entry to the cache file."""
+        self._append_entries([(key, val)])
+
+    def _append_entries(self, items: list):
+        """Appends entries to the cache file, compacting the file if it has accumulated too many stale records."""
+        if self.backend == "sqlite" or not items:
+            # already written by self.cache[key] = val
+            return
+        with self.file_lock:
+            # catch up on what others have written since we last synced: if one of them died mid-append, the file ends in a
+            # torn record, and anything appended after it would be lost, so the reload flags the file for a rewrite instead
+            try:
+                disk_stat = self._stat_signature(os.stat(self.cache_file))
+            except FileNotFoundError:
+                disk_stat = None
+            if disk_stat is not None and disk_stat != self._disk.stat:
+                self._load_cache_from_disk(use_lock=True)
+                with self.thread_lock:
+                    # ours are newer than anything the reload read
+                    self.cache.update(items)
+            if self._should_compact():
+                self._write_cache_to_disk(use_lock=False, pending=dict(items))
+                return
+            with open(self.cache_file, "ab") as f:
+                # if nobody else has written since we last synced, then we don't need to reload our own write
+                up_to_date = (
+                    self._stat_signature(os.fstat(f.fileno())) == self._disk.stat
+                )
+                write = self._record_writer()
+                for key, val in items:
+                    write(f, key, val)
+                f.flush()
+                os.fsync(f.fileno())
+                if up_to_date:
+                    self._disk.stat = self._stat_signature(os.fstat(f.fileno()))
+                    self._disk.offset = self._disk.stat[1]
+            self._disk.num_records += len(items)
+
+    def _flush(self):
+        """Appends any results that are only cached in memory to the cache file."""
+        with self._flush_lock:
+            with self.thread_lock:
+                items = list(self._dirty.items())
+                self._dirty.clear()
+            try:
+                self._append_entries(items)
+            except BaseException:
+                with self.thread_lock:
+                    # keep them for the next flush, unless they have been overwritten since
+                    for key, val in items:
+                        self._dirty.setdefault(key, val)
+                raise
+
+    @property
+    def _buffers_writes(self) -> bool:
+        return self.flush_interval is not None or self.flush_threshold is not None
+
+    def _flush_periodically(self):
+        while True:
+            self._flush_requested.wait(self.flush_interval)
+            self._flush_requested.clear()
+            try:
+                self._flush()
+            except Exception as e:
+                logging.error(f"Failed to flush {self.cache_file}: {e}")
 
     @staticmethod
     def kwargs_of_key(key: KEY) -> frozendict:
         """Returns the kwargs of a key."""
+        if isinstance(key, bytes):
+            raise TypeError("Cannot recover the kwargs of a hashed key")
         return key[1]
 
     @staticmethod
     def args_of_key(key: KEY) -> tuple:
         """Returns the args of a key."""
+        if isinstance(key, bytes):
+            raise TypeError("Cannot recover the args of a hashed key")
         return key[0]
 
     def _uncache(self, key: KEY):
         """Removes a key from the cache."""
+        if self.backend == "sqlite":
+            # the delete is a single transaction on the database, which does its own locking
+            with self.thread_lock:
+                self._dirty.pop(key, None)
+                self._hot.pop(key, None)
+                del self.cache[key]
+            return
         with self.file_lock:
-            self._load_cache_from_disk(use_lock=False)
-            del self.cache[key]
+            self._maybe_reload_cache()
+            with self.thread_lock:
+                self._dirty.pop(key, None)
+                self._hot.pop(key, None)
+                del self.cache[key]
             self._write_cache_to_disk(skip_load=True, use_lock=False)
 
     def uncache(self, *args, **kwargs):
-        return self._uncache((to_immutable(args), to_immutable(kwargs)))
+        return self._uncache(self._key(*args, **kwargs))
 
     @classmethod
     def sync_all(cls):
-        """Writes all caches to disk."""
+        """Writes all caches to disk, compacting any cache files that have accumulated too many stale records.
+        Every result not yet on disk is pending in memory, so otherwise this only needs to flush those (after waiting for any
+        flush that the background thread has already started).
+        """
         for instance in cls.instances.values():
-            instance._write_cache_to_disk()
+            instance._flush()
+            if instance.backend == "sqlite" or instance._should_compact():
+                instance._write_cache_to_disk()
 
     @staticmethod
     def key_of_args(*args, **kwargs) -> KEY:
         return (to_immutable(args), to_immutable(kwargs))
 
+    def _key(self, *args, **kwargs) -> KEY:
+        """Returns the cache key for a call, respecting hash_keys."""
+        if self.hash_keys:
+            return digest_of_args(args, kwargs)
+        return self.key_of_args(*args, **kwargs)
+
     def _update_df(self, key: KEY, val: Any):
-        if self.df is not None and pd is not None:
+        if self._df_rows is not None:
             with self.df_thread_lock:
                 if key not in self.df_cache:
                     self.df_cache.add(key)
-                    new_row = pd.DataFrame({"input": [key], "output": [val]})
-                    self.df = pd.concat([self.df, new_row], ignore_index=True)
+                    self._df_rows.append({"input": key, "output": val})
+
+    @property
+    def df(self):
+        """A DataFrame of the inputs and outputs of the calls made so far, or None if pandas is not used."""
+        if self._df_rows is None:
+            return None
+        with self.df_thread_lock:
+            if (
+                self._df_materialized is None
+                or len(self._df_rows) != self._df_num_materialized
+            ):
+                self._df_materialized = pd.DataFrame(
+                    self._df_rows, columns=["input", "output"]
+                )
+                self._df_num_materialized = len(self._df_rows)
+            return self._df_materialized
 
     def _process_half_async_result(self, key, val):
-        if (isinstance(val, tuple) or isinstance(val, list)) and any(
-            inspect.isawaitable(x) for x in val
-        ):
+        is_awaitable = (
+            [inspect.isawaitable(x) for x in val]
+            if isinstance(val, tuple) or isinstance(val, list)
+            else None
+        )
+        if is_awaitable and any(is_awaitable):
             list_vals = list(val)
+            # the result is cached once the last of the awaitables finishes
+            num_pending = [sum(is_awaitable)]
 
             def process_val(i, v):
-                if inspect.isawaitable(v):
+                if is_awaitable[i]:
 
                     async def await_v(v):
                         v = await v
                         list_vals[i] = v
-                        if not any(inspect.isawaitable(x) for x in list_vals):
+                        num_pending[0] -= 1
+                        if num_pending[0] == 0:
                             await self._async_overwrite_result(
                                 key, type(val)(list_vals)
                             )
@@ -246,74 +871,145 @@ class Memoize:
             self._sync_overwrite_result(key, val)
             return val
 
+    def _get_hot(self, key: KEY) -> Any:
+        """Returns the value for key from the LRU, or _MISSING."""
+        val = self._hot.get(key, _MISSING)
+        if val is not _MISSING:
+            try:
+                self._hot.move_to_end(key)
+            except KeyError:  # evicted by another thread in the meantime
+                pass
+        return val
+
+    def _set_hot(self, key: KEY, val: Any):
+        with self.thread_lock:
+            self._hot[key] = val
+            self._hot.move_to_end(key)
+            while len(self._hot) > self.hot_cache_size:
+                self._hot.popitem(last=False)
+
     def _sync_overwrite_result(self, key, val):
-        self.cache[key] = val
-        self._write_cache_to_disk()
+        if self._buffers_writes:
+            with self.thread_lock:
+                self.cache[key] = val
+                self._dirty[key] = val
+                if (
+                    self.flush_threshold is not None
+                    and len(self._dirty) >= self.flush_threshold
+                ):
+                    self._flush_requested.set()
+        else:
+            self.cache[key] = val
+            self._append_entry(key, val)
+        self._set_hot(key, val)
+        return val
 
     async def _async_overwrite_result(self, key, val):
+        if self._buffers_writes:
+            self._sync_overwrite_result(key, val)
+            return
         self.cache[key] = val
-        await asyncio.to_thread(self._write_cache_to_disk)
+        await asyncio.to_thread(self._append_entry, key, val)
+        self._set_hot(key, val)
 
     def get(self, *args, **kwargs):
         """Gets a value from the cache."""
-        key = self.key_of_args(*args, **kwargs)
+        key = self._key(*args, **kwargs)
 
         if not self.disk_write_only:
-            self._load_cache_from_disk()
+            self._maybe_reload_cache()
 
         return self.cache[key]
 
     async def aget(self, *args, **kwargs):
         """Gets a value from the cache."""
-        key = self.key_of_args(*args, **kwargs)
+        key = self._key(*args, **kwargs)
 
         if not self.disk_write_only:
-            await asyncio.to_thread(self._load_cache_from_disk)
+            await self._async_maybe_reload_cache()
 
         return self.cache[key]
 
     def _sync_call(self, *args, **kwargs):
         """Calls the function, caching the result if it hasn't been called with the same arguments before."""
-        key = self.key_of_args(*args, **kwargs)
+        key = self._key(*args, **kwargs)
+
+        val = self._get_hot(key)
+        if val is not _MISSING:
+            return val
 
         if not self.disk_write_only:
-            self._load_cache_from_disk()
+            self._maybe_reload_cache()
 
-        try:
-            val = self.cache[key]
-        except KeyError:
+        val = self.cache.get(key, _MISSING)
+        if val is _MISSING:
             val = self.func(*args, **kwargs)
             val = (
                 self._sync_overwrite_result(key, val)
                 if not self.process_half_async
                 else self._process_half_async_result(key, val)
             )
+        else:
+            self._set_hot(key, val)
 
         self._update_df(key, val)
         return val
 
     async def _async_call(self, *args, **kwargs):
         """Calls the function, caching the result if it hasn't been called with the same arguments before."""
-        key = self.key_of_args(*args, **kwargs)
+        key = self._key(*args, **kwargs)
+
+        val = self._get_hot(key)
+        if val is not _MISSING:
+            return val
 
         if not self.disk_write_only:
-            await asyncio.to_thread(self._load_cache_from_disk)
+            await self._async_maybe_reload_cache()
 
-        try:
-            val = self.cache[key]
-        except KeyError:
-            val = await self.func(*args, **kwargs)
-            await self._async_overwrite_result(key, val)
+        # Nothing below awaits between looking up the key and registering the call as in flight, so other
+        # coroutines can't interleave here and no lock is needed.  Futures belong to a single event loop,
+        # so a call running in another thread's loop is not waited on.
+        val = self.cache.get(key, _MISSING)
+        if val is _MISSING:
+            loop = asyncio.get_running_loop()
+            # if another call with the same arguments is already running, wait for it rather than computing it again
+            future = self._inflight.get(key)
+            if future is not None and future.get_loop() is loop:
+                try:
+                    return await asyncio.shield(future)
+                except asyncio.CancelledError:
+                    if not future.cancelled():
+                        raise
+                    # the call we were waiting on was cancelled, so make our own
+                    return await self._async_call(*args, **kwargs)
+            future = loop.create_future()
+            is_owner = self._inflight.setdefault(key, future) is future
+            try:
+                val = await self.func(*args, **kwargs)
+                await self._async_overwrite_result(key, val)
+            except Exception as e:
+                future.set_exception(e)
+                future.exception()  # don't warn about the exception if nobody was waiting
+                raise
+            except BaseException:
+                future.cancel()
+                raise
+            else:
+                future.set_result(val)
+            finally:
+                if is_owner:
+                    del self._inflight[key]
+        else:
+            self._set_hot(key, val)
 
         self._update_df(key, val)
         return val
 
     def __call__(self, *args, **kwargs):
         """Calls the function, caching the result if it hasn't been called with the same arguments before."""
-        if inspect.iscoroutinefunction(self.func) or self.force_async:
-            return self._async_call(*args, **kwargs)
-        else:
-            return self._sync_call(*args, **kwargs)
+        return (self._async_call if self._is_async else self._sync_call)(
+            *args, **kwargs
+        )
 
     @contextmanager
     def sync_cache(self, inplace: bool = False):
@@ -341,3 +1037,6 @@ class Memoize:
         return (
             f"Memoize(func={self.func}, name={self.name}, cache_file={self.cache_file})"
         )
+
+
+atexit.register(Memoize.sync_all)
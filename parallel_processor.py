@@ -1,9 +1,18 @@
 # imports
-from typing import Any, Awaitable, Callable, Iterable, Iterator, Optional
+from typing import Any, Awaitable, Callable, Iterator, Mapping, Optional
 import asyncio  # for running API calls concurrently
+from collections import (
+    defaultdict,
+    deque,
+)  # for batching results and tracking latencies
+from contextlib import nullcontext  # for optionally skipping the concurrency limit
+import heapq  # for retrying requests in order of when they are due
 import json  # for saving results to a jsonl file
 import logging  # for logging rate limit warnings and other messages
-import time  # for sleeping after rate limit is hit
+import os  # for syncing results to disk
+import random  # for jittering retry delays
+import re  # for parsing rate limit reset durations
+import time  # for scheduling retries and timing requests
 from dataclasses import (
     dataclass,
     field,
@@ -17,17 +26,63 @@ async def process_api_requests(
     max_attempts: int,
     is_rate_limit_exception: Callable[[Exception], bool],
     is_api_exception: Callable[[Exception], bool],
-    tqdm_requests: Optional[Iterator] = None,
+    tqdm_requests: Optional[Any] = None,
+    max_burst_requests: Optional[float] = None,
+    rate_limiters: Optional[Mapping[Any, "AsyncTokenBucket"]] = None,
+    rate_limiter_key: Optional[Callable[[Callable[[], Awaitable[Any]]], Any]] = None,
+    concurrency_limiter: Optional["AdaptiveConcurrencyLimiter"] = None,
+    retry_after_of_exception: Optional[Callable[[Exception], Optional[float]]] = None,
+    seconds_to_first_retry: float = 1,
+    max_seconds_between_retries: float = 60,
+    blocking_iterator: bool = False,
+    output_file: Optional[str] = None,
+    max_waiting_requests: int = 1000,
 ):
-    """Processes API requests in parallel, throttling to stay under rate limits."""
+    """Processes API requests in parallel, throttling to stay under rate limits.
+
+    Requests are throttled by a token bucket refilling at max_requests_per_minute, which allows bursts of up to max_burst_requests
+    (by default, one second's worth).  To limit requests to different providers separately, pass rate_limiters, a mapping to
+    AsyncTokenBucket, and rate_limiter_key, which maps a request to its key in rate_limiters; requests whose key is not in
+    rate_limiters share the max_requests_per_minute bucket.  Each rate limiter dispatches its own requests in order, independently
+    of the others, so a throttled or paused limiter holds up only the requests waiting on it.  Once max_waiting_requests requests
+    are waiting for their rate limiters, no more are read until one of them is dispatched.
+
+    If concurrency_limiter is given, it also caps how many requests are in flight at once, adapting the cap to rate limit errors
+    and latency.
+
+    A rate limit error pauses the rate limiter of the request that hit it, for as long as retry_after_of_exception says
+    (by default, the exception's Retry-After header) or else 15 seconds; requests on other rate limiters are not paused.
+
+    A failed request is retried after an exponential backoff with jitter, starting at seconds_to_first_retry and doubling with
+    each failure up to max_seconds_between_retries; other requests go ahead in the meantime.
+
+    If getting the next request from requests may block (e.g. it reads files or queries a database), pass blocking_iterator=True
+    to run it in a worker thread, so that it doesn't stall the requests in flight.
+
+    If output_file is given, each successful request should return an iterable of JSON-serializable records, which are appended
+    to output_file as JSON lines (skipping lines already in it) by a single writer task, in batches.
+
+    If tqdm_requests is given, it should be a progress bar such as tqdm(total=...), which is updated as each request finishes.
+    """
     # constants
     seconds_to_pause_after_rate_limit_error = 15
-    seconds_to_sleep_each_loop = (
-        0.001  # 1 ms limits max throughput to 1,000 requests per second
-    )
 
     # initialize trackers
-    queue_of_requests_to_retry = asyncio.Queue()
+    # a heap of (time.monotonic() when due, task_id, request)
+    queue_of_requests_to_retry = []
+    # (file_path, record) pairs for jsonl_writer, which writes every result so that tasks never touch the file themselves
+    output_queue = asyncio.Queue() if output_file is not None else None
+    writer = (
+        asyncio.create_task(jsonl_writer(output_queue))
+        if output_queue is not None
+        else None
+    )
+    # set whenever a task finishes, which may have queued a retry or let the loop exit,
+    # and whenever a waiting request is dispatched, which makes room to read another
+    wake_up = asyncio.Event()
+    # requests waiting for a token from each rate limiter, and the task dispatching them
+    waiting_requests_of_rate_limiter = defaultdict(deque)
+    dispatcher_of_rate_limiter = {}
     task_id_generator = (
         task_id_generator_function()
     )  # generates integer IDs of 0, 1, 2, ...
@@ -36,26 +91,82 @@ async def process_api_requests(
     )  # single instance to track a collection of variables
     next_request = None  # variable to hold the next request to call
 
-    # initialize available capacity counts
-    available_request_capacity = max_requests_per_minute
-    last_update_time = time.time()
+    # initialize available capacity
+    default_rate_limiter = AsyncTokenBucket(
+        max_requests_per_minute / 60.0, capacity=max_burst_requests
+    )
+
+    def rate_limiter_of_request(request: APIRequest) -> AsyncTokenBucket:
+        if rate_limiters is None or rate_limiter_key is None:
+            return default_rate_limiter
+        return rate_limiters.get(
+            rate_limiter_key(request.request_func), default_rate_limiter
+        )
+
+    def num_waiting_requests() -> int:
+        return sum(map(len, waiting_requests_of_rate_limiter.values()))
+
+    async def dispatch_waiting_requests(rate_limiter: AsyncTokenBucket):
+        """Calls the API for the requests waiting on rate_limiter, in order, as soon as it (and concurrency_limiter) allow."""
+        waiting_requests = waiting_requests_of_rate_limiter[rate_limiter]
+        while waiting_requests:
+            await rate_limiter.acquire()
+            if concurrency_limiter is not None:
+                await concurrency_limiter.acquire()
+            request = waiting_requests.popleft()
+            # update counters
+            request.attempts_left -= 1
+
+            # call API
+            task = asyncio.create_task(
+                request.call_api(
+                    retry_queue=queue_of_requests_to_retry,
+                    status_tracker=status_tracker,
+                    is_rate_limit_exception=is_rate_limit_exception,
+                    is_api_exception=is_api_exception,
+                    tqdm_requests=tqdm_requests,
+                    concurrency_limiter=concurrency_limiter,
+                    rate_limiter=rate_limiter,
+                    seconds_to_pause_after_rate_limit_error=seconds_to_pause_after_rate_limit_error,
+                    retry_after_of_exception=retry_after_of_exception
+                    or seconds_to_retry_after,
+                    seconds_to_first_retry=seconds_to_first_retry,
+                    max_seconds_between_retries=max_seconds_between_retries,
+                    output_queue=output_queue,
+                    output_file=output_file,
+                )
+            )
+            task.add_done_callback(lambda _: wake_up.set())
+            wake_up.set()
+        del dispatcher_of_rate_limiter[rate_limiter]
 
     iterator_not_finished = True
     logging.debug(f"Initialization complete.")
 
     logging.debug(f"Entering main loop")
     while True:
-        # get next request (if one is not already waiting for capacity)
+        # get next request
+        is_retry = False
         if next_request is None:
-            if not queue_of_requests_to_retry.empty():
-                next_request = queue_of_requests_to_retry.get_nowait()
+            if (
+                queue_of_requests_to_retry
+                and queue_of_requests_to_retry[0][0] <= time.monotonic()
+            ):
+                next_request = heapq.heappop(queue_of_requests_to_retry)[-1]
+                is_retry = True
                 logging.debug(
                     f"Retrying request {next_request.task_id}: {next_request}"
                 )
-            elif iterator_not_finished:
-                try:
-                    # get new request
-                    request_func = next(requests)
+            elif (
+                iterator_not_finished and num_waiting_requests() < max_waiting_requests
+            ):
+                # get new request
+                if blocking_iterator:
+                    # StopIteration can't be raised out of a thread into a coroutine, so use a default instead
+                    request_func = await asyncio.to_thread(next, requests, None)
+                else:
+                    request_func = next(requests, None)
+                if request_func is not None:
                     next_request = APIRequest(
                         task_id=next(task_id_generator),
                         request_func=request_func,
@@ -66,61 +177,50 @@ async def process_api_requests(
                     logging.debug(
                         f"Reading request {next_request.task_id}: {next_request}"
                     )
-                except StopIteration:
+                else:
                     # if iterator runs out, set flag to stop reading it
                     logging.debug("Iterator exhausted")
                     iterator_not_finished = False
 
-        # update available capacity
-        current_time = time.time()
-        seconds_since_update = current_time - last_update_time
-        available_request_capacity = min(
-            available_request_capacity
-            + max_requests_per_minute * seconds_since_update / 60.0,
-            max_requests_per_minute,
-        )
-
-        last_update_time = current_time
-
-        # if enough capacity available, call API
+        # leave the request to its rate limiter's dispatcher, so that the main loop never waits for capacity
         if next_request:
-            if available_request_capacity >= 1:
-                # update counters
-                available_request_capacity -= 1
-                next_request.attempts_left -= 1
-
-                # call API
-                asyncio.create_task(
-                    next_request.call_api(
-                        retry_queue=queue_of_requests_to_retry,
-                        status_tracker=status_tracker,
-                        is_rate_limit_exception=is_rate_limit_exception,
-                        is_api_exception=is_api_exception,
-                        tqdm_requests=tqdm_requests,
-                    )
+            rate_limiter = rate_limiter_of_request(next_request)
+            waiting_requests = waiting_requests_of_rate_limiter[rate_limiter]
+            if is_retry:
+                # retries go ahead of new requests, as they would have been read first
+                waiting_requests.appendleft(next_request)
+            else:
+                waiting_requests.append(next_request)
+            if rate_limiter not in dispatcher_of_rate_limiter:
+                dispatcher_of_rate_limiter[rate_limiter] = asyncio.create_task(
+                    dispatch_waiting_requests(rate_limiter)
                 )
-                next_request = None  # reset next_request to empty
+            next_request = None  # reset next_request to empty
 
         # if all tasks are finished, break
         if status_tracker.num_tasks_in_progress == 0:
             break
 
-        # main loop sleeps briefly so concurrent tasks can run
-        await asyncio.sleep(seconds_to_sleep_each_loop)
+        # main loop sleeps until it has something to do, so concurrent tasks can run
+        if iterator_not_finished and num_waiting_requests() < max_waiting_requests:
+            # there are more requests to read right away
+            await asyncio.sleep(0)
+        else:
+            # nothing to do until a task finishes or queues a retry, a waiting request is dispatched, or the next retry is due
+            seconds_to_wait = None
+            if queue_of_requests_to_retry:
+                seconds_to_wait = max(
+                    0, queue_of_requests_to_retry[0][0] - time.monotonic()
+                )
+            try:
+                await asyncio.wait_for(wake_up.wait(), timeout=seconds_to_wait)
+            except asyncio.TimeoutError:
+                pass
+        wake_up.clear()
 
-        # if a rate limit error was hit recently, pause to cool down
-        seconds_since_rate_limit_error = (
-            time.time() - status_tracker.time_of_last_rate_limit_error
-        )
-        if seconds_since_rate_limit_error < seconds_to_pause_after_rate_limit_error:
-            remaining_seconds_to_pause = (
-                seconds_to_pause_after_rate_limit_error - seconds_since_rate_limit_error
-            )
-            await asyncio.sleep(remaining_seconds_to_pause)
-            # ^e.g., if pause is 15 seconds and final limit was hit 5 seconds ago
-            logging.warn(
-                f"Pausing to cool down until {time.ctime(status_tracker.time_of_last_rate_limit_error + seconds_to_pause_after_rate_limit_error)}"
-            )
+    if writer is not None:
+        await output_queue.put(None)
+        await writer
 
         # after finishing, log final status
     logging.info(f"""Parallel processing complete. I hope you cached your results!""")
@@ -134,6 +234,256 @@ async def process_api_requests(
         )
 
 
+# writing results
+
+
+def read_lines(file_path) -> set:
+    if not os.path.exists(file_path):
+        return set()
+    with open(file_path, "r") as file:
+        return set(file.readlines())
+
+
+def append_lines(lines_by_file: dict):
+    """Appends lines to files, syncing each file to disk once for all of its lines."""
+    for file_path, lines in lines_by_file.items():
+        with open(file_path, "a") as file:
+            file.writelines(lines)
+            file.flush()
+            os.fsync(file.fileno())
+
+
+async def jsonl_writer(queue: asyncio.Queue, batch_size=256, batch_seconds=0.1):
+    """Appends (file_path, record) pairs from the queue to their jsonl files, skipping duplicate lines, until it gets None.
+    Records are written in batches of up to batch_size, or whatever arrived within batch_seconds.
+    """
+    loop = asyncio.get_running_loop()
+    lines_of_file = {}
+    finished = False
+    while not finished:
+        batch = [await queue.get()]
+        deadline = loop.time() + batch_seconds
+        while len(batch) < batch_size and batch[-1] is not None:
+            try:
+                batch.append(
+                    await asyncio.wait_for(queue.get(), deadline - loop.time())
+                )
+            except asyncio.TimeoutError:
+                break
+        new_lines = defaultdict(list)
+        for item in batch:
+            if item is None:
+                finished = True
+                continue
+            file_path, record = item
+            if file_path not in lines_of_file:
+                lines_of_file[file_path] = await asyncio.to_thread(
+                    read_lines, file_path
+                )
+            line = json.dumps(record) + "\n"
+            if line in lines_of_file[file_path]:
+                logging.warning(f"Ignoring duplicate: {line[:40]}...")
+                continue
+            lines_of_file[file_path].add(line)
+            new_lines[file_path].append(line)
+        await asyncio.to_thread(append_lines, new_lines)
+
+
+# rate limiting
+
+
+class AsyncTokenBucket:
+    """Limits the rate of an async operation: acquire() waits until a token is available.
+    Tokens refill continuously at rate_per_sec, up to capacity."""
+
+    def __init__(self, rate_per_sec: float, capacity: Optional[float] = None):
+        self.max_rate_per_sec = rate_per_sec
+        self.rate_per_sec = rate_per_sec
+        self.capacity = capacity if capacity is not None else max(1.0, rate_per_sec)
+        self.tokens = self.capacity
+        self.last_update_time = time.monotonic()
+        # when a rate lowered by update_from_headers goes back to max_rate_per_sec
+        self.slowed_until = 0.0
+        # created on first use, so that it belongs to the running loop
+        self._lock = None
+
+    def _refill(self):
+        current_time = time.monotonic()
+        if current_time >= self.slowed_until:
+            self.rate_per_sec = self.max_rate_per_sec
+        self.tokens = min(
+            self.capacity,
+            self.tokens + (current_time - self.last_update_time) * self.rate_per_sec,
+        )
+        self.last_update_time = current_time
+
+    async def acquire(self, tokens: float = 1):
+        """Waits until tokens are available, and then takes them."""
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            self._refill()
+            while self.tokens < tokens:
+                await asyncio.sleep((tokens - self.tokens) / self.rate_per_sec)
+                self._refill()
+            self.tokens -= tokens
+
+    def pause(self, seconds: float):
+        """Takes away enough tokens that the next one will not be available for another seconds seconds."""
+        self._refill()
+        self.tokens = min(self.tokens, 1 - seconds * self.rate_per_sec)
+
+    def update_from_headers(self, headers: Mapping[str, str]):
+        """Caps the tokens at the provider's x-ratelimit-remaining-requests and, if x-ratelimit-limit-requests is given too, slows
+        down to the provider's refill rate until x-ratelimit-reset-requests, after which the rate goes back to max_rate_per_sec.
+
+        x-ratelimit-reset-requests is how long until the provider's budget is fully replenished, so it refills at
+        (limit - remaining) / reset requests per second.
+        """
+        remaining = headers.get("x-ratelimit-remaining-requests")
+        reset = headers.get("x-ratelimit-reset-requests")
+        if remaining is None or reset is None:
+            return
+        try:
+            remaining = float(remaining)
+            reset_seconds = seconds_of_duration(reset)
+        except ValueError:
+            return
+        self._refill()
+        self.tokens = min(self.tokens, remaining)
+        limit = headers.get("x-ratelimit-limit-requests")
+        try:
+            limit = float(limit) if limit is not None else None
+        except ValueError:
+            limit = None
+        if limit is not None and limit > remaining and reset_seconds > 0:
+            self.rate_per_sec = min(
+                self.max_rate_per_sec, (limit - remaining) / reset_seconds
+            )
+            self.slowed_until = time.monotonic() + reset_seconds
+
+
+def seconds_to_retry_after(e: Exception) -> Optional[float]:
+    """Returns how long the Retry-After (or retry-after-ms) header on the response of an exception asks us to wait, if it has one."""
+    headers = getattr(getattr(e, "response", None), "headers", None)
+    if headers is None:
+        return None
+    try:
+        if headers.get("retry-after-ms") is not None:
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after") is not None:
+            return float(headers["retry-after"])
+    except ValueError:
+        # e.g. an HTTP date
+        pass
+    return None
+
+
+def seconds_of_duration(duration: str) -> float:
+    """Parses durations like "20ms", "1s", or "6m0s" as used in rate limit headers."""
+    parts = re.findall(r"(\d+(?:\.\d+)?)(ms|h|m|s)", duration)
+    if not parts or "".join(n + u for n, u in parts) != duration.strip():
+        raise ValueError(f"Invalid duration {duration!r}")
+    scale = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+    return sum(float(n) * scale[u] for n, u in parts)
+
+
+def rate_limit(
+    func: Callable[..., Awaitable[Any]],
+    requests_per_minute: float,
+    max_concurrent: Optional[int] = None,
+):
+    """Wraps an async function so that calls wait for both a token from a token bucket and, if max_concurrent is given, a free concurrency slot.
+    Rate limit headers on results (or on the responses of exceptions) adjust the bucket's rate, and a Retry-After header pauses it.
+    """
+    bucket = AsyncTokenBucket(requests_per_minute / 60.0)
+    semaphore = asyncio.Semaphore(max_concurrent) if max_concurrent else None
+
+    async def rate_limited(*args, **kwargs):
+        async with semaphore if semaphore is not None else nullcontext():
+            await bucket.acquire()
+            try:
+                result = await func(*args, **kwargs)
+            except Exception as e:
+                headers = getattr(getattr(e, "response", None), "headers", None)
+                if headers is not None:
+                    bucket.update_from_headers(headers)
+                retry_after = seconds_to_retry_after(e)
+                if retry_after is not None:
+                    bucket.pause(retry_after)
+                raise
+            headers = getattr(result, "headers", None)
+            if headers is not None:
+                bucket.update_from_headers(headers)
+            return result
+
+    rate_limited.bucket = bucket
+    return rate_limited
+
+
+class AdaptiveConcurrencyLimiter:
+    """Limits how many calls are in flight at once, adapting the limit AIMD-style (as in TCP congestion control):
+    the limit grows by one after each limit's worth of successful calls, and is cut by decrease_factor on a rate limit error
+    or when the mean of the last latency_window latencies exceeds target_latency_seconds.
+    """
+
+    def __init__(
+        self,
+        initial_limit: int,
+        min_limit: int = 1,
+        max_limit: Optional[int] = None,
+        target_latency_seconds: Optional[float] = None,
+        latency_window: int = 20,
+        decrease_factor: float = 0.5,
+    ):
+        self.limit = initial_limit
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.target_latency_seconds = target_latency_seconds
+        self.decrease_factor = decrease_factor
+        self.in_flight = 0
+        self.latencies = deque(maxlen=latency_window)
+        self.successes_since_increase = 0
+        self.last_decrease_time = float("-inf")
+        # created on first use, so that it belongs to the running loop
+        self._slot_freed = None
+
+    async def acquire(self):
+        """Waits until fewer than limit calls are in flight, and then takes a slot."""
+        if self._slot_freed is None:
+            self._slot_freed = asyncio.Event()
+        while self.in_flight >= self.limit:
+            self._slot_freed.clear()
+            await self._slot_freed.wait()
+        self.in_flight += 1
+
+    def release(self, start_time: float, overloaded: bool = False):
+        """Frees the slot of a call that started at start_time (on the time.monotonic clock), adapting the limit to whether
+        the call was rate limited (overloaded) and how long it took."""
+        current_time = time.monotonic()
+        self.in_flight -= 1
+        self.latencies.append(current_time - start_time)
+        too_slow = (
+            self.target_latency_seconds is not None
+            and sum(self.latencies) / len(self.latencies) > self.target_latency_seconds
+        )
+        if overloaded or too_slow:
+            # calls that started before the last decrease were sent under the old limit, so they say nothing about the new one
+            if start_time > self.last_decrease_time:
+                self.limit = max(self.min_limit, int(self.limit * self.decrease_factor))
+                self.last_decrease_time = current_time
+                self.successes_since_increase = 0
+        else:
+            self.successes_since_increase += 1
+            if self.successes_since_increase >= self.limit and (
+                self.max_limit is None or self.limit < self.max_limit
+            ):
+                self.limit += 1
+                self.successes_since_increase = 0
+        if self._slot_freed is not None:
+            self._slot_freed.set()
+
+
 # dataclasses
 
 
@@ -148,7 +498,6 @@ class StatusTracker:
     num_rate_limit_errors: int = 0
     num_api_errors: int = 0  # excluding rate limit errors, counted above
     num_other_errors: int = 0
-    time_of_last_rate_limit_error: int = 0  # used to cool off after hitting rate limits
 
 
 @dataclass
@@ -159,18 +508,31 @@ class APIRequest:
     request_func: Callable[[], Awaitable[Any]]
     attempts_left: int
     result: list = field(default_factory=list)
+    next_retry_at: float = 0.0  # time.monotonic() at which to retry after a failure
 
     async def call_api(
         self,
-        retry_queue: asyncio.Queue,
+        retry_queue: list,
         status_tracker: StatusTracker,
         is_rate_limit_exception: Callable[[Exception], bool],
         is_api_exception: Callable[[Exception], bool],
-        tqdm_requests: Optional[Iterable] = None,
+        tqdm_requests: Optional[Any] = None,
+        concurrency_limiter: Optional[AdaptiveConcurrencyLimiter] = None,
+        rate_limiter: Optional[AsyncTokenBucket] = None,
+        seconds_to_pause_after_rate_limit_error: float = 15,
+        retry_after_of_exception: Optional[
+            Callable[[Exception], Optional[float]]
+        ] = seconds_to_retry_after,
+        seconds_to_first_retry: float = 1,
+        max_seconds_between_retries: float = 60,
+        output_queue: Optional[asyncio.Queue] = None,
+        output_file: Optional[str] = None,
     ):
-        """Calls the API"""
+        """Calls the API, releasing a slot already acquired from concurrency_limiter (if given) once the call returns"""
         logging.info(f"Starting request #{self.task_id}")
         error = None
+        rate_limited = False
+        start_time = time.monotonic()
         try:
             response = await self.request_func()
 
@@ -181,8 +543,18 @@ class APIRequest:
                 logging.warning(
                     f"Request {self.task_id} failed with rate limit exception {e}"
                 )
-                status_tracker.time_of_last_rate_limit_error = time.time()
                 status_tracker.num_rate_limit_errors += 1
+                if rate_limiter is not None:
+                    seconds_to_pause = None
+                    if retry_after_of_exception is not None:
+                        seconds_to_pause = retry_after_of_exception(e)
+                    if seconds_to_pause is None:
+                        seconds_to_pause = seconds_to_pause_after_rate_limit_error
+                    rate_limiter.pause(seconds_to_pause)
+                    logging.warning(
+                        f"Pausing to cool down for {seconds_to_pause} seconds"
+                    )
+                rate_limited = True
                 error = e
             elif is_api_exception(e):
                 logging.warning(f"Request {self.task_id} failed with API Exception {e}")
@@ -192,28 +564,47 @@ class APIRequest:
                 logging.warning(f"Request {self.task_id} failed with Exception {e}")
                 status_tracker.num_other_errors += 1
                 error = e
+        finally:
+            # even if the call was cancelled, so that its slot isn't lost
+            if concurrency_limiter is not None:
+                concurrency_limiter.release(start_time, overloaded=rate_limited)
         if error:
             self.result.append(error)
             if self.attempts_left:
-                retry_queue.put_nowait(self)
+                # back off exponentially, with jitter so that requests that failed together don't retry together
+                seconds_to_retry = min(
+                    max_seconds_between_retries,
+                    seconds_to_first_retry * 2 ** (len(self.result) - 1),
+                ) + random.uniform(0, seconds_to_first_retry)
+                self.next_retry_at = time.monotonic() + seconds_to_retry
+                heapq.heappush(retry_queue, (self.next_retry_at, self.task_id, self))
             else:
                 logging.error(
                     f"Request {self.request_func} failed after all attempts. Errors: {self.result}"
                 )
                 status_tracker.num_tasks_in_progress -= 1
                 status_tracker.num_tasks_failed += 1
-                next(tqdm_requests, None)
+                _tick(tqdm_requests)
         else:
             status_tracker.num_tasks_in_progress -= 1
             status_tracker.num_tasks_succeeded += 1
             logging.info(f"Request {self.task_id} completed successfully")
             logging.debug(f"Request {self.task_id} returned {response}")
-            next(tqdm_requests, None)
+            if output_queue is not None:
+                for record in response:
+                    output_queue.put_nowait((output_file, record))
+            _tick(tqdm_requests)
 
 
 # functions
 
 
+def _tick(tqdm_requests: Optional[Any]):
+    """Advances the progress bar (if any) by one finished request."""
+    if tqdm_requests is not None:
+        tqdm_requests.update(1)
+
+
 def task_id_generator_function():
     """Generate integers 0, 1, 2, and so on."""
     task_id = 0